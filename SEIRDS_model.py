@@ -1,5 +1,5 @@
 import numpy as np
-from topography import nearest_neighbour_topography
+from topography import nearest_neighbour_topography, nearest_neighbour_stencil, KroneckerTopography
 
 class SEIRDS_Model:
     """
@@ -80,18 +80,26 @@ class SEIRDS_Model:
         Time evolve each cell of the model by one timestep. The size of the timestep
         is dt. The rate of exposure is beta. The rate of infection is
         sigma. The rate of recovery/quarantine/death is gamma.
-        """
 
-        size = self.n.size
-        assert topography.shape == (size, size)
+        The topography is either a matrix over all cells, or an object with
+        an apply method such as KroneckerTopography, in which case the cells
+        may be (ages, rows, cols).
+        """
 
         # This is the standard SEIR model, except that we also allow neighbouring cells
         # to expose susceptible individuals according to the given topology matrix.
 
         infectious = self.beta * dt * self.scale * self.i
-        infectious.shape = (1, size)
-        exposure = infectious.dot(topography)
-        exposure.shape = self.s.shape
+        if hasattr(topography, "apply"):
+            # structured topography, such as KroneckerTopography, that never
+            # forms the full matrix
+            exposure = topography.apply(infectious)
+        else:
+            size = self.n.size
+            assert topography.shape == (size, size)
+            infectious.shape = (1, size)
+            exposure = infectious.dot(topography)
+            exposure.shape = self.s.shape
         newly_exposed = exposure * self.s
         newly_infected = self.sigma * dt * self.e
         newly_resistant = self.gamma * dt * self.i
@@ -180,8 +188,36 @@ def test_total_dead_by_beta():
 
         print(f"beta={beta} number_dead={model.number_dead()}")
 
+def test_365_steps_kronecker_topography():
+
+    beta = 3.0 * 26.0 # infect three people in the space of two weeks
+    sigma = 52.0  # about one week to change from exposed to infected
+    gamma = 26.0  # about two weeks infected
+    digamma = 0.26  # about 1% of those infected die
+    rho = 1.0     # about one year to become susceptible again
+
+    # three age groups, mixing mostly within their own group
+    contact = np.array([[1.0, 0.3, 0.1], [0.3, 0.8, 0.2], [0.1, 0.2, 0.5]])
+    populations = np.full((3, 4, 5), 100.0)
+    kronecker = KroneckerTopography(contact, nearest_neighbour_stencil(1.0, 0.1))
+    dense = kronecker.dense(populations.shape[1:])
+
+    model = SEIRDS_Model(populations, beta, sigma, gamma, digamma, rho)
+    model.infect((1, 0, 0))
+    expected = SEIRDS_Model(populations, beta, sigma, gamma, digamma, rho)
+    expected.infect((1, 0, 0))
+
+    for _ in range(365):
+        model.timestep(1.0 / 365.0, kronecker)
+        expected.timestep(1.0 / 365.0, dense)
+
+    print(f"age-structured number_dead={model.number_dead()}")
+    assert np.allclose(model.i, expected.i)
+    assert np.allclose(model.d, expected.d)
+
 if __name__ == "__main__":
     test_one_step_identity_topography()
     test_365_steps_identity_topography()
     test_365_steps_nearest_neighbour_topography()
+    test_365_steps_kronecker_topography()
     test_total_dead_by_beta()
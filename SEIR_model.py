@@ -70,18 +70,26 @@ class SEIR_Model:
         Time evolve each cell of the model by one timestep. The size of the timestep
         is dt. The rate of exposure is beta. The rate of infection is
         sigma. The rate of recovery/quarantine/death is gamma.
-        """
 
-        size = self.n.size
-        assert topography.shape == (size, size)
+        The topography is either a matrix over all cells, or an object with
+        an apply method such as KroneckerTopography, in which case the cells
+        may be (ages, rows, cols).
+        """
 
         # This is the standard SEIR model, except that we also allow neighbouring cells
         # to expose susceptible individuals according to the given topology matrix.
 
         infectious = self.beta * dt * self.scale * self.i
-        infectious.shape = (1, size)
-        exposure = infectious.dot(topography)
-        exposure.shape = self.s.shape
+        if hasattr(topography, "apply"):
+            # structured topography, such as KroneckerTopography, that never
+            # forms the full matrix
+            exposure = topography.apply(infectious)
+        else:
+            size = self.n.size
+            assert topography.shape == (size, size)
+            infectious.shape = (1, size)
+            exposure = infectious.dot(topography)
+            exposure.shape = self.s.shape
         newly_exposed = exposure * self.s
         newly_infected = self.sigma * dt * self.e
         newly_resistant = self.gamma * dt * self.i
@@ -3,36 +3,33 @@ import numpy as np
 from topography import nearest_neighbour_topography, exponential_topography, stratified_topography
 from SEIR_model import SEIR_Model
 from SEIRDS_model import SEIRDS_Model
+from simulation import aggregate_series
+from result_cache import ResultCache
 from math import exp, log
 
-def evolve(model, topography, has_d, tau):
+def evolve(model, topography, has_d, tau, cache=None):
 
     STEPS = 365
     timesteps = np.arange(0, STEPS, 1)
     ONE_DAY = 1.0 / 365.0
 
-    S = np.zeros(STEPS)
-    E = np.zeros(STEPS)
-    I = np.zeros(STEPS)
-    R = np.zeros(STEPS)
+    N = np.sum(model.s)
+    if cache is not None:
+        series = cache.run(model, topography, STEPS, ONE_DAY)
+    else:
+        series = aggregate_series(model, topography, STEPS, ONE_DAY)
+
+    S = series["s"]
+    E = series["e"]
+    I = series["i"]
+    R = series["r"]
     if has_d:
-        D = np.zeros(STEPS)
+        D = series["d"]
     r_factor = np.zeros(STEPS)
-    N = np.sum(model.s)
-
-    for i, _ in enumerate(timesteps):
-        model.timestep(ONE_DAY, topography)
 
-        S[i] = np.sum(model.s)
-        E[i] = np.sum(model.e)
-        I[i] = np.sum(model.i)
-        R[i] = np.sum(model.r)
-        if has_d:
-            D[i] = np.sum(model.d)
-        
-        if i > 0:
-            effective_beta = (S[i - 1] - S[i]) * N / (S[i - 1] * I[i - 1] * ONE_DAY)
-            r_factor[i - 1] = effective_beta * tau
+    for i in range(1, STEPS):
+        effective_beta = (S[i - 1] - S[i]) * N / (S[i - 1] * I[i - 1] * ONE_DAY)
+        r_factor[i - 1] = effective_beta * tau
 
     # fudge the last points for prettiness
     r_factor[-1] = r_factor[-2]
@@ -63,7 +60,7 @@ def evolve(model, topography, has_d, tau):
     fig.savefig(f"{name}.png")
     plt.show()
 
-def evolve_SEIR():
+def evolve_SEIR(cache=None):
     beta = 3.0 * 26.0 # infect three people in the space of two weeks
     sigma = 52.0  # about one week to change from exposed to infected
     gamma = 26.0  # about two weeks infected
@@ -73,9 +70,9 @@ def evolve_SEIR():
     model.infect((0, 0))
 
     topography = nearest_neighbour_topography(populations.shape, 1.0, 0.1)
-    evolve(model, topography, False, 1.0 / gamma)
+    evolve(model, topography, False, 1.0 / gamma, cache)
 
-def evolve_SEIR_stratified():
+def evolve_SEIR_stratified(cache=None):
     beta = 3.0 * 26.0 # infect three people in the space of two weeks
     sigma = 52.0  # about one week to change from exposed to infected
     gamma = 26.0  # about two weeks infected
@@ -90,9 +87,9 @@ def evolve_SEIR_stratified():
 
     #topography = stratified_topography(populations.shape, 10.0, 0.6, 0.6)
     topography = stratified_topography(populations.shape, 1.0, 0.6, 0.6)
-    evolve(model, topography, False, 1.0 / gamma)
+    evolve(model, topography, False, 1.0 / gamma, cache)
 
-def evolve_SEIRDS():
+def evolve_SEIRDS(cache=None):
 
     beta = 3.0 * 26.0 # infect three people in the space of two weeks
     sigma = 52.0  # about one week to change from exposed to infected
@@ -106,10 +103,10 @@ def evolve_SEIRDS():
 
     topography = exponential_topography(populations.shape, 1.0, 1.5)
     #topography = nearest_neighbour_topography(populations.shape, 1.0, 0.1)
-    evolve(model, topography, True, 1.0 / gamma)
+    evolve(model, topography, True, 1.0 / gamma, cache)
 
 
-def evolve_SEIRDS_stratified():
+def evolve_SEIRDS_stratified(cache=None):
     beta = 3.0 * 26.0 # infect three people in the space of two weeks
     sigma = 52.0  # about one week to change from exposed to infected
     gamma = 26.0  # about two weeks infected
@@ -126,7 +123,8 @@ def evolve_SEIRDS_stratified():
 
     #topography = stratified_topography(populations.shape, 10.0, 0.6, 0.6)
     topography = stratified_topography(populations.shape, 1.0, 0.6, 0.6)
-    evolve(model, topography, True, 1.0 / gamma)
+    evolve(model, topography, True, 1.0 / gamma, cache)
 
 if __name__ == '__main__':
-    evolve_SEIR_stratified()
\ No newline at end of file
+    # re-running the same setup is served from the result cache
+    evolve_SEIR_stratified(ResultCache("result_cache"))
\ No newline at end of file
@@ -0,0 +1,386 @@
+import copy
+import hashlib
+import os
+import tempfile
+import threading
+import weakref
+import numpy as np
+from topography import nearest_neighbour_topography, nearest_neighbour_stencil, \
+    StencilTopography, KroneckerTopography
+from SEIR_model import SEIR_Model
+from SEIRDS_model import SEIRDS_Model
+from simulation import compartments, aggregate_series
+
+# Bump this if the meaning of a cached entry changes, so that old entries
+# are never matched.
+CACHE_VERSION = 1
+
+class Uncacheable(TypeError):
+    """
+    Raised for a value whose content update_digest does not know how to
+    hash, so that results depending on it are never cached.
+    """
+
+# Classes whose whole content lives in their instance attributes
+HASHED_BY_ATTRIBUTES = (SEIR_Model, SEIRDS_Model, StencilTopography, KroneckerTopography)
+
+def update_digest(digest, value):
+    """
+    Feed a value into a hash, so that equal content gives an equal hash.
+    Only types whose content is known are hashed: arrays, scalars,
+    containers, the models and the topographies, plus scipy.sparse
+    matrices. Anything else, such as a function, raises Uncacheable.
+    """
+    if isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            raise Uncacheable(f"cannot hash an array of {value.dtype}")
+        digest.update(f"ndarray{value.dtype.str}{value.shape}".encode())
+        # hash the buffer in place rather than copying it with tobytes()
+        digest.update(memoryview(np.ascontiguousarray(value)))
+    elif value is None or isinstance(value, (bool, int, float, str, np.generic)):
+        digest.update(f"{type(value).__name__}:{value!r}".encode())
+    elif isinstance(value, (list, tuple)):
+        digest.update(f"{type(value).__name__}{len(value)}".encode())
+        for item in value:
+            update_digest(digest, item)
+    elif isinstance(value, dict):
+        digest.update(f"dict{len(value)}".encode())
+        for name in sorted(value):
+            update_digest(digest, name)
+            update_digest(digest, value[name])
+    elif type(value) in HASHED_BY_ATTRIBUTES:
+        digest.update(type(value).__qualname__.encode())
+        update_digest(digest, vars(value))
+    elif type(value).__module__.startswith("scipy.sparse"):
+        # canonical compressed rows, so that equal matrices hash equally
+        csr = value.tocsr(copy=True)
+        csr.sum_duplicates()
+        digest.update(b"sparse")
+        update_digest(digest, (csr.shape, csr.data, csr.indices, csr.indptr))
+    else:
+        raise Uncacheable(f"cannot hash {type(value).__qualname__}")
+
+class ResultCache:
+    """
+    Content-addressed, size-bounded disk cache of simulation results.
+
+    An entry is keyed by a hash of the model type and its entire initial
+    state (populations, parameters and any infections), the topography
+    contents and the timestep. Scenarios involving anything update_digest
+    cannot hash are run without the cache. The number of steps is not part of the key:
+    each entry records how many steps it holds, so a request for fewer steps
+    is served from the start of the cached series, and a request for more
+    steps resumes from the cached final state and extends the entry.
+
+    Entries are .npz files in the given directory. When the directory grows
+    beyond max_bytes, the least recently used entries are evicted.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024, store_state: bool = True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.store_state = store_state
+        self.lock = threading.Lock()
+        self.topography_digests = {}
+        self.hits = 0
+        self.misses = 0
+        self.resumes = 0
+        self.uncached = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def remember(self, topography):
+        """
+        Hashing a large dense topography is not free. An owner that promises
+        never to change a topography again, such as the scenario service
+        with its warm topographies, can register it here so that its hash is
+        computed once. The hash is forgotten when the topography is garbage
+        collected. Unregistered topographies are hashed on every call.
+        """
+        result = self.hash_topography(topography)
+        with self.lock:
+            self.topography_digests[id(topography)] = (weakref.ref(topography), result)
+        weakref.finalize(topography, self.forget_topography, id(topography))
+        return topography
+
+    def topography_digest(self, topography) -> str:
+        with self.lock:
+            remembered = self.topography_digests.get(id(topography))
+        if remembered is not None and remembered[0]() is topography:
+            return remembered[1]
+        return self.hash_topography(topography)
+
+    def hash_topography(self, topography) -> str:
+        digest = hashlib.sha256()
+        update_digest(digest, topography)
+        return digest.hexdigest()
+
+    def forget_topography(self, topography_id: int):
+        with self.lock:
+            remembered = self.topography_digests.get(topography_id)
+            if remembered is not None and remembered[0]() is None:
+                del self.topography_digests[topography_id]
+
+    def key(self, model, topography, dt: float) -> str:
+        digest = hashlib.sha256()
+        update_digest(digest, CACHE_VERSION)
+        update_digest(digest, model)
+        update_digest(digest, self.topography_digest(topography))
+        update_digest(digest, float(dt))
+        return digest.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def load(self, key: str) -> dict:
+        path = self.path(key)
+        try:
+            with np.load(path) as entry:
+                result = {name: entry[name] for name in entry.files}
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        # mark as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return result
+
+    def store(self, key: str, series: dict, state: dict):
+        entry = {f"series_{name}": values for name, values in series.items()}
+        if state is not None:
+            entry.update({f"state_{name}": values for name, values in state.items()})
+
+        # write to a temporary file and rename, so that readers never see a
+        # partially written entry
+        handle, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as f:
+                np.savez(f, **entry)
+            with self.lock:
+                os.replace(temp, self.path(key))
+                self.evict()
+        except BaseException:
+            try:
+                os.remove(temp)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        """
+        Delete every entry. Stores in progress on other threads are not
+        disturbed, as their temporary files are left alone.
+        """
+        with self.lock:
+            for name in os.listdir(self.directory):
+                if name.endswith(".npz"):
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except FileNotFoundError:
+                        pass
+
+    def run(self, model, topography, steps: int, dt: float) -> dict:
+        """
+        Returns the same series as aggregate_series(model, topography,
+        steps, dt), served from the cache where possible.
+
+        Unlike aggregate_series, the model passed in is never advanced,
+        whether or not the result came from the cache: the evolution runs on
+        a copy. Use aggregate_series directly when the final state is needed.
+        """
+        names = compartments(model)
+        try:
+            key = self.key(model, topography, dt)
+        except Uncacheable:
+            self.count("uncached")
+            return aggregate_series(copy.deepcopy(model), topography, steps, dt)
+        model = copy.deepcopy(model)
+        entry = self.load(key)
+
+        if entry is not None:
+            cached_steps = len(entry["series_s"])
+            has_state = "state_s" in entry
+            if steps <= cached_steps:
+                self.count("hits")
+                return {name: entry[f"series_{name}"][:steps].copy() for name in names}
+
+            if has_state:
+                self.count("resumes")
+                for name in names:
+                    getattr(model, name)[...] = entry[f"state_{name}"]
+                extra = aggregate_series(model, topography, steps - cached_steps, dt)
+                series = {name: np.concatenate((entry[f"series_{name}"], extra[name])) for name in names}
+                self.store(key, series, self.state(model))
+                return series
+
+        self.count("misses")
+        series = aggregate_series(model, topography, steps, dt)
+        self.store(key, series, self.state(model))
+        return series
+
+    def count(self, counter: str):
+        # runs on several service worker threads at once
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def state(self, model) -> dict:
+        if not self.store_state:
+            return None
+        return {name: getattr(model, name) for name in compartments(model)}
+
+def test_hit_resume_and_prefix():
+    cache = ResultCache(tempfile.mkdtemp())
+    populations = np.full((4, 4), 100.0)
+    topography = nearest_neighbour_topography(populations.shape, 1.0, 0.1)
+    dt = 1.0 / 365.0
+
+    def fresh_model():
+        model = SEIRDS_Model(populations, 78.0, 52.0, 26.0, 0.26, 1.0)
+        model.infect((0, 0))
+        return model
+
+    expected = aggregate_series(fresh_model(), topography, 200, dt)
+
+    # miss, then resume from the cached end state
+    first = cache.run(fresh_model(), topography, 120, dt)
+    resumed_model = fresh_model()
+    resumed = cache.run(resumed_model, topography, 200, dt)
+    assert (cache.misses, cache.resumes) == (1, 1)
+    for name in "seird":
+        assert np.allclose(first[name], expected[name][:120])
+        assert np.allclose(resumed[name], expected[name])
+
+    # exact hit, and a shorter hit serving a prefix
+    hit_model = fresh_model()
+    hit = cache.run(hit_model, topography, 200, dt)
+    prefix = cache.run(fresh_model(), topography, 50, dt)
+    assert cache.hits == 2
+    assert np.allclose(hit["i"], expected["i"])
+    assert np.allclose(prefix["r"], expected["r"][:50])
+
+    # the models passed in are never advanced, hit, miss or resume
+    untouched = fresh_model()
+    for model in (resumed_model, hit_model):
+        for name in "seird":
+            assert np.array_equal(getattr(model, name), getattr(untouched, name))
+    cache.clear()
+
+def test_key_depends_on_inputs():
+    cache = ResultCache(tempfile.mkdtemp())
+    populations = np.full((3, 3), 100.0)
+    topography = nearest_neighbour_topography(populations.shape, 1.0, 0.1)
+
+    model = SEIR_Model(populations, 78.0, 52.0, 26.0)
+    same = SEIR_Model(populations.copy(), 78.0, 52.0, 26.0)
+    other_beta = SEIR_Model(populations, 79.0, 52.0, 26.0)
+    infected = SEIR_Model(populations, 78.0, 52.0, 26.0)
+    infected.infect((1, 1))
+
+    key = cache.key(model, topography, 0.01)
+    assert cache.key(same, topography.copy(), 0.01) == key
+    assert cache.key(other_beta, topography, 0.01) != key
+    assert cache.key(infected, topography, 0.01) != key
+    assert cache.key(model, topography * 2.0, 0.01) != key
+    assert cache.key(model, topography, 0.02) != key
+    cache.clear()
+
+def test_topography_changed_in_place():
+    cache = ResultCache(tempfile.mkdtemp())
+    populations = np.full((3, 3), 100.0)
+    topography = nearest_neighbour_topography(populations.shape, 1.0, 0.1)
+
+    def fresh_model():
+        model = SEIR_Model(populations, 78.0, 52.0, 26.0)
+        model.infect((0, 0))
+        return model
+
+    cache.run(fresh_model(), topography, 50, 1.0 / 365.0)
+    topography *= 2.0
+    changed = cache.run(fresh_model(), topography, 50, 1.0 / 365.0)
+    expected = aggregate_series(fresh_model(), topography, 50, 1.0 / 365.0)
+    assert (cache.hits, cache.misses) == (0, 2)
+    assert np.allclose(changed["i"], expected["i"])
+
+    # read-only flags are not trusted, as they can be toggled back
+    topography.flags.writeable = False
+    cache.run(fresh_model(), topography, 50, 1.0 / 365.0)
+    topography.flags.writeable = True
+    topography *= 1.5
+    topography.flags.writeable = False
+    toggled = cache.run(fresh_model(), topography, 50, 1.0 / 365.0)
+    expected = aggregate_series(fresh_model(), topography, 50, 1.0 / 365.0)
+    assert (cache.hits, cache.misses) == (1, 3)
+    assert np.allclose(toggled["i"], expected["i"])
+    assert len(cache.topography_digests) == 0
+
+    # a registered topography has its hash remembered until it is collected
+    cache.remember(topography)
+    cache.run(fresh_model(), topography, 50, 1.0 / 365.0)
+    assert cache.hits == 2 and len(cache.topography_digests) == 1
+    del topography
+    assert len(cache.topography_digests) == 0
+    cache.clear()
+
+def test_unknown_types_are_not_cached():
+    for value in (lambda: 1, object(), np.array([None])):
+        try:
+            update_digest(hashlib.sha256(), value)
+            assert False, f"expected {value!r} to be uncacheable"
+        except Uncacheable:
+            pass
+
+    class Opaque:
+        __slots__ = ("contact", "spatial")
+
+        def apply(self, x):
+            return x
+
+    cache = ResultCache(tempfile.mkdtemp())
+    populations = np.full((2, 3, 3), 100.0)
+    model = SEIR_Model(populations, 78.0, 52.0, 26.0)
+    model.infect((0, 0, 0))
+    series = cache.run(model, Opaque(), 10, 0.01)
+    assert len(series["i"]) == 10
+    assert (cache.uncached, cache.misses) == (1, 0)
+
+    # the known topography classes are hashed by content
+    kronecker = KroneckerTopography(np.identity(2), nearest_neighbour_stencil(1.0, 0.1))
+    other = KroneckerTopography(np.identity(2), nearest_neighbour_stencil(1.0, 0.2))
+    assert cache.hash_topography(kronecker) != cache.hash_topography(other)
+    cache.clear()
+
+def test_eviction():
+    cache = ResultCache(tempfile.mkdtemp(), max_bytes=1)
+    populations = np.full((3, 3), 100.0)
+    topography = np.identity(populations.size)
+    for beta in (10.0, 20.0, 30.0):
+        cache.run(SEIR_Model(populations, beta, 52.0, 26.0), topography, 10, 0.01)
+    assert len(os.listdir(cache.directory)) <= 1
+    cache.clear()
+
+if __name__ == "__main__":
+    test_hit_resume_and_prefix()
+    test_key_depends_on_inputs()
+    test_topography_changed_in_place()
+    test_unknown_types_are_not_cached()
+    test_eviction()
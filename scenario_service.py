@@ -0,0 +1,650 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import OrderedDict
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from topography import nearest_neighbour_topography, exponential_topography, \
+    fast_exponential_topography, stratified_topography
+from SEIR_model import SEIR_Model
+from SEIRDS_model import SEIRDS_Model
+from simulation import aggregate_series
+from result_cache import ResultCache
+
+MODELS = {
+    "SEIR": (SEIR_Model, ("beta", "sigma", "gamma")),
+    "SEIRDS": (SEIRDS_Model, ("beta", "sigma", "gamma", "digamma", "rho")),
+}
+
+TOPOGRAPHIES = {
+    "identity": lambda shape: np.identity(shape[0] * shape[1]),
+    "nearest_neighbour": nearest_neighbour_topography,
+    "exponential": exponential_topography,
+    "fast_exponential": fast_exponential_topography,
+    "stratified": stratified_topography,
+}
+
+# Scenario specs are small; anything larger than this is refused unread
+MAX_BODY_BYTES = 16 * 1024 * 1024
+
+def frozen(topography: np.ndarray) -> np.ndarray:
+    """
+    Warm topographies are shared between scenarios, so make them read-only.
+    """
+    topography.flags.writeable = False
+    return topography
+
+def build_populations(spec) -> np.ndarray:
+    """
+    Populations are either given explicitly as nested lists, or as
+    {"shape": [rows, cols], "value": population_per_cell}.
+    """
+    if isinstance(spec, dict):
+        return np.full(tuple(spec["shape"]), float(spec["value"]))
+    return np.array(spec, dtype=float)
+
+def parse_infection(infection, shape: (int, int)) -> ((int, int), float):
+    """
+    An infection is [row, col, amount]: one in-range integer index per
+    dimension of the populations, then a non-negative amount. Anything
+    else would silently infect a whole row or every cell.
+    """
+    if not isinstance(infection, list) or len(infection) != len(shape) + 1:
+        raise ValueError(f"infection {infection!r} must be {len(shape)} indices and an amount")
+    *cell, amount = infection
+    for index, size in zip(cell, shape):
+        if isinstance(index, bool) or not isinstance(index, int) or not 0 <= index < size:
+            raise ValueError(f"infection {infection!r} has an index outside populations {shape}")
+    if isinstance(amount, bool) or not isinstance(amount, (int, float)) \
+            or not np.isfinite(amount) or amount < 0.0:
+        raise ValueError(f"infection {infection!r} must have a finite, non-negative amount")
+    return tuple(cell), float(amount)
+
+class ScenarioService:
+    """
+    Long-running service that evolves SEIR and SEIRDS scenarios on request.
+
+    Topographies are expensive to build, so they are kept in memory keyed
+    by their kind, shape and arguments, and shared between all scenarios
+    that ask for the same one. Together they are kept within
+    max_topography_bytes by evicting the least recently used, and a
+    scenario whose topography alone would exceed that is rejected.
+
+    Scenarios run on a pool of worker threads (numpy releases the GIL for
+    the matrix products that dominate a timestep) and at most
+    max_concurrent run at once; the rest wait. If a
+    result_cache.ResultCache is given, repeated or extended scenarios are
+    served from it.
+
+    A scenario spec is a JSON object such as:
+
+    {"model": "SEIRDS",
+     "populations": {"shape": [30, 30], "value": 100.0},
+     "params": {"beta": 78.0, "sigma": 52.0, "gamma": 26.0,
+                "digamma": 0.26, "rho": 1.0},
+     "topography": {"kind": "nearest_neighbour", "args": [1.0, 0.1]},
+     "infect": [[0, 0, 1.0]],
+     "steps": 365,
+     "dt": 0.0027397}
+
+    and the reply is {"steps": ..., "series": {"s": [...], "e": [...], ...}}.
+    """
+
+    def __init__(
+            self,
+            max_concurrent: int = 4,
+            cache=None,
+            max_topography_bytes: int = 256 * 1024 * 1024,
+            max_steps: int = 365 * 100):
+        self.max_concurrent = max_concurrent
+        self.cache = cache
+        self.max_topography_bytes = max_topography_bytes
+        self.max_steps = max_steps
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent)
+        self.semaphore = None
+        self.topographies = OrderedDict()
+        self.completed = 0
+        self.waiting = 0
+        self.running = 0
+
+    async def topography(self, spec: dict, shape: (int, int)):
+        """
+        Fetch a warm topography, building it on the worker pool the first
+        time it is requested. Concurrent requests for the same topography
+        wait on the same build rather than each building their own.
+        """
+        kind = spec.get("kind", "identity")
+        args = tuple(spec.get("args", ()))
+        if kind not in TOPOGRAPHIES:
+            raise ValueError(f"unknown topography kind {kind}")
+
+        size = shape[0] * shape[1]
+        nbytes = size * size * np.dtype(float).itemsize
+        if nbytes > self.max_topography_bytes:
+            raise ValueError(f"topography for populations {shape} needs {nbytes} bytes, "
+                f"more than the limit of {self.max_topography_bytes}")
+
+        key = (kind, shape, args)
+        build = self.topographies.get(key)
+        if build is None:
+            loop = asyncio.get_running_loop()
+            build = loop.run_in_executor(
+                self.executor, lambda: self.warm(TOPOGRAPHIES[kind](shape, *args)))
+            self.topographies[key] = build
+            self.evict_topographies(key)
+        else:
+            self.topographies.move_to_end(key)
+        try:
+            return await asyncio.shield(build)
+        except Exception:
+            # do not cache failed builds
+            if self.topographies.get(key) is build:
+                del self.topographies[key]
+            raise
+
+    def warm(self, topography: np.ndarray) -> np.ndarray:
+        """
+        Prepare a newly built topography for sharing. We never change it
+        again, so the result cache may remember its hash.
+        """
+        frozen(topography)
+        if self.cache is not None:
+            self.cache.remember(topography)
+        return topography
+
+    def evict_topographies(self, keep):
+        """
+        Drop the least recently used topographies until the rest fit in
+        max_topography_bytes. Scenarios already holding one keep using it.
+        """
+        def nbytes(key):
+            size = key[1][0] * key[1][1]
+            return size * size * np.dtype(float).itemsize
+
+        total = sum(nbytes(key) for key in self.topographies)
+        for key in list(self.topographies):
+            if total <= self.max_topography_bytes:
+                break
+            if key != keep:
+                del self.topographies[key]
+                total -= nbytes(key)
+
+    async def run(self, spec: dict) -> dict:
+        """
+        Run one scenario spec, returning the aggregated series.
+        """
+        if not isinstance(spec, dict):
+            raise ValueError("a scenario spec must be a JSON object")
+        model_name = spec.get("model", "SEIR")
+        if model_name not in MODELS:
+            raise ValueError(f"unknown model {model_name}")
+        model_class, param_names = MODELS[model_name]
+
+        populations = build_populations(spec["populations"])
+        if populations.ndim != 2 or populations.size == 0:
+            raise ValueError(f"populations must be a non-empty (rows, cols) grid, not shape {populations.shape}")
+        params = spec["params"]
+        model = model_class(populations, *[float(params[name]) for name in param_names])
+        infections = spec.get("infect", [[0, 0, 1.0]])
+        if not isinstance(infections, list):
+            raise ValueError("infect must be a list of infections")
+        for infection in infections:
+            model.infect(*parse_infection(infection, populations.shape))
+
+        steps = int(spec.get("steps", 365))
+        if not 0 < steps <= self.max_steps:
+            raise ValueError(f"steps must be between 1 and {self.max_steps}, not {steps}")
+        dt = float(spec.get("dt", 1.0 / 365.0))
+
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrent)
+
+        topography = await self.topography(spec.get("topography", {}), populations.shape)
+        if topography.shape != (populations.size, populations.size):
+            raise ValueError(f"topography shape {topography.shape} does not match populations {populations.shape}")
+
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        try:
+            loop = asyncio.get_running_loop()
+            evolve = self.cache.run if self.cache is not None else aggregate_series
+            series = await loop.run_in_executor(
+                self.executor, evolve, model, topography, steps, dt)
+        finally:
+            self.running -= 1
+            self.semaphore.release()
+        self.completed += 1
+
+        return {
+            "steps": steps,
+            "series": {name: values.tolist() for name, values in series.items()},
+        }
+
+    def status(self) -> dict:
+        return {
+            "completed": self.completed,
+            "waiting": self.waiting,
+            "running": self.running,
+            "topographies": len(self.topographies),
+            "max_concurrent": self.max_concurrent,
+            "cache_hits": self.cache.hits if self.cache is not None else 0,
+        }
+
+    async def handle(self, reader, writer):
+        """
+        Minimal HTTP/1.1 handler: POST /run with a JSON scenario spec, or
+        GET /status. Connections are kept alive so that a client can submit
+        many scenarios without reconnecting.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                request = request_line.decode("latin-1").split()
+                if len(request) != 3:
+                    # we cannot trust the framing of anything that follows
+                    await self.reply(writer, 400, {"error": "malformed request line"})
+                    break
+                method, path, _ = request
+
+                try:
+                    length = int(headers.get("content-length", 0))
+                except ValueError:
+                    length = -1
+                if length < 0 or length > MAX_BODY_BYTES:
+                    await self.reply(writer, 400, {"error": "malformed or oversized content-length"})
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                try:
+                    if method == "POST" and path == "/run":
+                        status, reply = 200, await self.run(json.loads(body))
+                    elif method == "GET" and path == "/status":
+                        status, reply = 200, self.status()
+                    else:
+                        status, reply = 404, {"error": f"no route for {method} {path}"}
+                except (ValueError, KeyError, TypeError, IndexError) as e:
+                    status, reply = 400, {"error": str(e)}
+                except Exception as e:
+                    # one bad scenario must not kill a keep-alive connection
+                    status, reply = 500, {"error": f"{type(e).__name__}: {e}"}
+
+                await self.reply(writer, status, reply)
+
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def reply(self, writer, status: int, reply: dict):
+        payload = json.dumps(reply).encode()
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}[status]
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload)
+        await writer.drain()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8019, path: str = None):
+        """
+        Start listening on a TCP port, or on a Unix socket if a path is given.
+        """
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle, path=path)
+        return await asyncio.start_server(self.handle, host, port)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+async def request(reader, writer, method: str, path: str, body: dict = None) -> (int, dict):
+    """
+    Send one request over an open keep-alive connection and read the reply.
+    """
+    payload = json.dumps(body).encode() if body is not None else b""
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\n"
+        f"Host: localhost\r\n"
+        f"Content-Type: application/json\r\n"
+        f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload)
+    await writer.drain()
+
+    status_line = await reader.readline()
+    status = int(status_line.split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, value = line.decode("latin-1").split(":", 1)
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+async def load_test(
+        specs: [dict],
+        clients: int,
+        host: str = "127.0.0.1",
+        port: int = 8019,
+        path: str = None) -> dict:
+    """
+    Local load generator. Opens the given number of concurrent client
+    connections, which between them submit every spec once, and reports
+    throughput and latency percentiles in seconds.
+    """
+    queue = asyncio.Queue()
+    for spec in specs:
+        queue.put_nowait(spec)
+    latencies = []
+
+    async def client():
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while not queue.empty():
+                spec = queue.get_nowait()
+                start = time.perf_counter()
+                status, reply = await request(reader, writer, "POST", "/run", spec)
+                latencies.append(time.perf_counter() - start)
+                if status != 200:
+                    raise RuntimeError(f"scenario failed: {reply}")
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    # no point opening connections that would have nothing to submit
+    await asyncio.gather(*[client() for _ in range(min(clients, len(specs)))])
+    elapsed = time.perf_counter() - start
+
+    ordered = sorted(latencies)
+    def percentile(p):
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    return {
+        "requests": len(ordered),
+        "elapsed": elapsed,
+        "throughput": len(ordered) / elapsed if elapsed > 0.0 else 0.0,
+        "p50": percentile(0.5),
+        "p95": percentile(0.95),
+        "max": percentile(1.0),
+    }
+
+def example_spec(beta: float) -> dict:
+    return {
+        "model": "SEIR",
+        "populations": {"shape": [10, 10], "value": 100.0},
+        "params": {"beta": beta, "sigma": 52.0, "gamma": 26.0},
+        "topography": {"kind": "nearest_neighbour", "args": [1.0, 0.1]},
+        "infect": [[0, 0, 1.0]],
+        "steps": 100,
+    }
+
+def test_run_matches_direct_evolution():
+    service = ScenarioService(2)
+    spec = example_spec(78.0)
+    reply = asyncio.run(service.run(spec))
+    service.close()
+
+    populations = np.full((10, 10), 100.0)
+    model = SEIR_Model(populations, 78.0, 52.0, 26.0)
+    model.infect((0, 0))
+    topography = nearest_neighbour_topography(populations.shape, 1.0, 0.1)
+    series = aggregate_series(model, topography, 100, 1.0 / 365.0)
+
+    for name in "seir":
+        assert np.allclose(reply["series"][name], series[name])
+
+def test_topography_is_shared():
+    service = ScenarioService(2)
+
+    async def run_many():
+        return await asyncio.gather(*[service.run(example_spec(beta)) for beta in (50.0, 60.0, 70.0)])
+
+    replies = asyncio.run(run_many())
+    service.close()
+
+    assert len(replies) == 3
+    assert len(service.topographies) == 1
+    assert service.completed == 3
+    assert (service.waiting, service.running) == (0, 0)
+
+def test_cached_runs_remember_warm_topography():
+    import tempfile
+    cache = ResultCache(tempfile.mkdtemp())
+    service = ScenarioService(2, cache)
+
+    async def run_twice():
+        first = await service.run(example_spec(78.0))
+        second = await service.run(example_spec(78.0))
+        return first, second
+
+    first, second = asyncio.run(run_twice())
+    service.close()
+
+    assert first == second
+    assert (cache.misses, cache.hits) == (1, 1)
+    assert len(cache.topography_digests) == 1
+    cache.clear()
+
+def test_status_splits_waiting_and_running():
+    import threading
+
+    class BlockingCache:
+        hits = 0
+
+        def __init__(self):
+            self.release = threading.Event()
+
+        def remember(self, topography):
+            return topography
+
+        def run(self, model, topography, steps, dt):
+            self.release.wait()
+            return aggregate_series(model, topography, steps, dt)
+
+    cache = BlockingCache()
+    service = ScenarioService(1, cache)
+
+    async def run_three():
+        tasks = [asyncio.create_task(service.run(example_spec(beta))) for beta in (50.0, 60.0, 70.0)]
+        while service.running + service.waiting < 3 and not any(task.done() for task in tasks):
+            await asyncio.sleep(0.01)
+        status = service.status()
+        cache.release.set()
+        await asyncio.gather(*tasks)
+        return status
+
+    status = asyncio.run(run_three())
+    service.close()
+
+    assert (status["running"], status["waiting"]) == (1, 2)
+    assert service.status()["running"] == 0 and service.status()["waiting"] == 0
+
+def test_topography_store_is_bounded():
+    # room for two 10x10 topographies of 80000 bytes each, but not three
+    service = ScenarioService(2, max_topography_bytes=200000)
+
+    async def run_kinds():
+        for args in ([1.0, 0.1], [1.0, 0.2], [1.0, 0.3], [1.0, 0.1]):
+            spec = example_spec(78.0)
+            spec["topography"]["args"] = args
+            await service.run(spec)
+
+        too_big = example_spec(78.0)
+        too_big["populations"] = {"shape": [20, 20], "value": 100.0}
+        try:
+            await service.run(too_big)
+            assert False, "expected the topography to be rejected"
+        except ValueError:
+            pass
+
+    asyncio.run(run_kinds())
+    service.close()
+
+    assert list(key[2] for key in service.topographies) == [(1.0, 0.3), (1.0, 0.1)]
+
+def test_http_load():
+    service = ScenarioService(2)
+
+    async def serve_and_load():
+        server = await service.start(port=0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            specs = [example_spec(float(beta)) for beta in range(40, 120, 5)]
+            stats = await load_test(specs, 4, port=port)
+
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            status, reply = await request(reader, writer, "GET", "/status")
+            assert status == 200 and reply["completed"] == len(specs)
+            status, reply = await request(reader, writer, "POST", "/run", {"model": "SIR"})
+            assert status == 400
+            bad_shape = example_spec(78.0)
+            bad_shape["populations"] = {"shape": [2, 3, 4], "value": 100.0}
+            status, reply = await request(reader, writer, "POST", "/run", bad_shape)
+            assert status == 400
+            for infect in ([[0, 1.0]], [[5.0]], [[10, 0, 1.0]], [[0.5, 0, 1.0]], [[0, 0, -1.0]], [0, 0, 1.0]):
+                bad_infection = example_spec(78.0)
+                bad_infection["infect"] = infect
+                status, reply = await request(reader, writer, "POST", "/run", bad_infection)
+                assert status == 400, f"infect {infect} was accepted"
+            too_long = example_spec(78.0)
+            too_long["steps"] = 10 ** 12
+            status, reply = await request(reader, writer, "POST", "/run", too_long)
+            assert status == 400
+            status, reply = await request(reader, writer, "POST", "/run", [1, 2])
+            assert status == 400
+            status, reply = await request(reader, writer, "GET", "/status")
+            assert status == 200
+            writer.close()
+
+            # a malformed request line gets a reply rather than a dropped connection
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"NONSENSE\r\n\r\n")
+            status_line = await reader.readline()
+            assert status_line.startswith(b"HTTP/1.1 400")
+            writer.close()
+
+            for length in (b"-5", b"nine", str(MAX_BODY_BYTES + 1).encode()):
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(b"POST /run HTTP/1.1\r\nContent-Length: " + length + b"\r\n\r\n")
+                status_line = await reader.readline()
+                assert status_line.startswith(b"HTTP/1.1 400")
+                writer.close()
+            return stats
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    stats = asyncio.run(serve_and_load())
+    service.close()
+    print(f"test_http_load {stats}")
+    assert stats["requests"] == 16
+
+def test_load_with_no_specs():
+    stats = asyncio.run(load_test([], 2, port=1))
+    assert stats["requests"] == 0 and stats["max"] is None
+
+def test_internal_error_keeps_connection():
+    class FailingService(ScenarioService):
+        async def run(self, spec: dict) -> dict:
+            raise AssertionError("simulated failure")
+
+    service = FailingService(1)
+
+    async def serve_and_fail():
+        server = await service.start(port=0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            status, reply = await request(reader, writer, "POST", "/run", example_spec(78.0))
+            assert status == 500 and "simulated failure" in reply["error"]
+            status, reply = await request(reader, writer, "GET", "/status")
+            assert status == 200
+            writer.close()
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(serve_and_fail())
+    service.close()
+
+async def serve(
+        max_concurrent: int = 4,
+        port: int = 8019,
+        cache_directory: str = None,
+        max_topography_bytes: int = 256 * 1024 * 1024):
+    cache = ResultCache(cache_directory) if cache_directory is not None else None
+    service = ScenarioService(max_concurrent, cache, max_topography_bytes)
+    server = await service.start(port=port)
+    print(f"scenario service listening on port {port}")
+    async with server:
+        await server.serve_forever()
+
+async def load(clients: int, count: int, port: int = 8019, local: bool = False, max_concurrent: int = 4):
+    """
+    Submit count example scenarios, with a spread of betas, from the given
+    number of clients. If local, start a service in this process first.
+    """
+    specs = [example_spec(40.0 + 80.0 * i / max(count, 1)) for i in range(count)]
+    if not local:
+        return await load_test(specs, clients, port=port)
+
+    service = ScenarioService(max_concurrent)
+    server = await service.start(port=0)
+    try:
+        return await load_test(specs, clients, port=server.sockets[0].getsockname()[1])
+    finally:
+        server.close()
+        await server.wait_closed()
+        service.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SEIR/SEIRDS scenario service")
+    commands = parser.add_subparsers(dest="command")
+
+    serve_parser = commands.add_parser("serve", help="run the service (the default)")
+    serve_parser.add_argument("--port", type=int, default=8019)
+    serve_parser.add_argument("--max-concurrent", type=int, default=4)
+    serve_parser.add_argument("--cache-dir", default=None, help="enable the result cache in this directory")
+    serve_parser.add_argument("--max-topography-bytes", type=int, default=256 * 1024 * 1024)
+
+    load_parser = commands.add_parser("load", help="measure throughput and latency")
+    load_parser.add_argument("--clients", type=int, default=4)
+    load_parser.add_argument("--specs", type=int, default=100, help="number of scenarios to submit")
+    load_parser.add_argument("--port", type=int, default=8019)
+    load_parser.add_argument("--local", action="store_true", help="start a service in this process")
+    load_parser.add_argument("--max-concurrent", type=int, default=4, help="for a local service")
+
+    args = parser.parse_args(argv)
+    if args.command == "load":
+        stats = asyncio.run(load(args.clients, args.specs, args.port, args.local, args.max_concurrent))
+        for name, value in stats.items():
+            print(f"{name}={value}")
+    elif args.command == "serve":
+        asyncio.run(serve(args.max_concurrent, args.port, args.cache_dir, args.max_topography_bytes))
+    else:
+        asyncio.run(serve())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+import numpy as np
+
+def compartments(model) -> [str]:
+    """
+    The names of the state vectors held by the model, in SEIR(D) order.
+    """
+    names = ["s", "e", "i", "r"]
+    if hasattr(model, "d"):
+        names.append("d")
+    return names
+
+def aggregate_series(model, topography, steps: int, dt: float) -> dict:
+    """
+    Time evolve the model by the given number of timesteps, returning the
+    population of each compartment summed over all cells after every step.
+    This is the same aggregation that graphs.evolve plots, without plotting.
+    """
+    names = compartments(model)
+    series = {name: np.zeros(steps) for name in names}
+
+    for step in range(steps):
+        model.timestep(dt, topography)
+        for name in names:
+            series[name][step] = np.sum(getattr(model, name))
+
+    return series
@@ -112,6 +112,105 @@ def stratified_topography(
 
     return result
 
+class StencilTopography:
+    """
+    Represents a translation-invariant topography without forming a matrix.
+    Each point is exposed to the points around it, weighted by a small odd
+    sized kernel centred on the point itself:
+
+    exposure[row, col] = sum(kernel[h + dr, h + dc] * x[row + dr, col + dc])
+
+    Points beyond the edges contribute nothing, as in the matrix topographies.
+    """
+
+    def __init__(self, kernel: np.ndarray):
+        assert kernel.ndim == 2
+        assert kernel.shape[0] % 2 == 1 and kernel.shape[1] % 2 == 1
+        self.kernel = kernel
+
+    def apply(self, x: np.ndarray) -> np.ndarray:
+        """
+        Applies the stencil over the last two (row, col) dimensions of x.
+        """
+        h_row = self.kernel.shape[0] // 2
+        h_col = self.kernel.shape[1] // 2
+        rows, cols = x.shape[-2:]
+        padding = [(0, 0)] * (x.ndim - 2) + [(h_row, h_row), (h_col, h_col)]
+        padded = np.pad(x, padding)
+
+        result = np.zeros(x.shape)
+        for (k_row, k_col), coupling in np.ndenumerate(self.kernel):
+            if coupling != 0.0:
+                result += coupling * padded[..., k_row:k_row + rows, k_col:k_col + cols]
+        return result
+
+    def dense(self, shape: (int, int)) -> np.ndarray:
+        """
+        The equivalent matrix topography, for testing small cases.
+        """
+        size = shape[0] * shape[1]
+        result = np.zeros((size, size))
+        for src in range(size):
+            unit = np.zeros(size)
+            unit[src] = 1.0
+            result[src, :] = self.apply(unit.reshape(shape)).reshape(size)
+        return result
+
+def nearest_neighbour_stencil(
+        self_coupling: float,
+        neighbour_coupling: float) -> StencilTopography:
+    """
+    The stencil equivalent of nearest_neighbour_topography.
+    """
+    kernel = np.full((3, 3), neighbour_coupling)
+    kernel[1, 1] = self_coupling
+    return StencilTopography(kernel)
+
+class KroneckerTopography:
+    """
+    Represents a topography over (ages, rows, cols) as the Kronecker product
+    of a small age contact matrix and a spatial topography, without forming
+    the (ages * rows * cols)^2 matrix:
+
+    T[(a, p), (b, q)] = contact[a, b] * spatial[p, q]
+
+    The spatial topography may be a dense matrix, a sparse matrix (anything
+    with .T and .dot, such as scipy.sparse) or a StencilTopography. Applying
+    it is two small contractions, so memory is proportional to the factors.
+    """
+
+    def __init__(self, contact: np.ndarray, spatial):
+        assert contact.ndim == 2 and contact.shape[0] == contact.shape[1]
+        self.contact = contact
+        self.spatial = spatial
+
+    def apply(self, x: np.ndarray) -> np.ndarray:
+        """
+        Equivalent to the row vector product x . T, with x of shape
+        (ages, rows, cols): the result is contact^T . X . spatial where X is
+        x reshaped to (ages, rows * cols).
+        """
+        ages = self.contact.shape[0]
+        assert x.ndim == 3, f"state must be (ages, rows, cols), not shape {x.shape}"
+        assert x.shape[0] == ages
+
+        mixed = self.contact.T.dot(x.reshape(ages, -1))
+        if hasattr(self.spatial, "apply"):
+            return self.spatial.apply(mixed.reshape(x.shape))
+
+        size = mixed.shape[1]
+        assert self.spatial.shape == (size, size)
+        return np.asarray(self.spatial.T.dot(mixed.T)).T.reshape(x.shape)
+
+    def dense(self, shape: (int, int)) -> np.ndarray:
+        """
+        The equivalent matrix topography, for testing small cases.
+        """
+        spatial = self.spatial.dense(shape) if hasattr(self.spatial, "dense") else self.spatial
+        if hasattr(spatial, "toarray"):
+            spatial = spatial.toarray()
+        return np.kron(self.contact, spatial)
+
 def test_nearest_neighbour():
     topography = nearest_neighbour_topography((4, 4), 1.0, 0.1)
     print(f"{topography}")
@@ -159,10 +258,81 @@ def test_stratified_topography():
     print("test_stratified_topography")
     print(f"{topography}")
 
+def test_nearest_neighbour_stencil():
+    stencil = nearest_neighbour_stencil(1.0, 0.1)
+    dense = nearest_neighbour_topography((4, 5), 1.0, 0.1)
+    assert np.allclose(stencil.dense((4, 5)), dense)
+
+def test_kronecker():
+    contact = np.array([[2.0, 0.5, 0.1], [0.3, 1.0, 0.2], [0.1, 0.4, 1.5]])
+    x = np.random.default_rng(1).random((3, 4, 5))
+
+    for spatial in (exponential_topography((4, 5), 1.0, 1.0), nearest_neighbour_stencil(1.0, 0.1)):
+        topography = KroneckerTopography(contact, spatial)
+        expected = x.reshape(1, -1).dot(topography.dense((4, 5))).reshape(x.shape)
+        assert np.allclose(topography.apply(x), expected)
+
+class _CoordinateMatrix:
+    """
+    Minimal sparse matrix with just the interface KroneckerTopography needs
+    from scipy.sparse, so that the sparse path is tested without scipy.
+    """
+
+    def __init__(self, entries: dict, shape: (int, int)):
+        self.entries = entries
+        self.shape = shape
+
+    @property
+    def T(self):
+        return _CoordinateMatrix({(j, i): v for (i, j), v in self.entries.items()}, self.shape[::-1])
+
+    def dot(self, other: np.ndarray) -> np.ndarray:
+        result = np.zeros((self.shape[0],) + other.shape[1:])
+        for (i, j), v in self.entries.items():
+            result[i] += v * other[j]
+        return result
+
+    def toarray(self) -> np.ndarray:
+        result = np.zeros(self.shape)
+        for (i, j), v in self.entries.items():
+            result[i, j] = v
+        return result
+
+def test_kronecker_sparse():
+    contact = np.array([[2.0, 0.5], [0.3, 1.0]])
+    dense = nearest_neighbour_topography((3, 4), 1.0, 0.1)
+    x = np.random.default_rng(2).random((2, 3, 4))
+    expected = x.reshape(1, -1).dot(np.kron(contact, dense)).reshape(x.shape)
+
+    rows, cols = np.nonzero(dense)
+    spatials = [_CoordinateMatrix({(i, j): dense[i, j] for i, j in zip(rows, cols)}, dense.shape)]
+    try:
+        import scipy.sparse
+        spatials.append(scipy.sparse.csr_matrix(dense))
+    except ImportError:
+        print("scipy not available, testing the sparse path without it")
+
+    for spatial in spatials:
+        topography = KroneckerTopography(contact, spatial)
+        assert np.allclose(topography.dense((3, 4)), np.kron(contact, dense))
+        assert np.allclose(topography.apply(x), expected)
+
+def test_kronecker_rejects_flat_state():
+    topography = KroneckerTopography(np.identity(2), nearest_neighbour_stencil(1.0, 0.1))
+    try:
+        topography.apply(np.ones((2, 12)))
+        assert False, "expected a (ages, cells) state to be rejected"
+    except AssertionError as e:
+        assert "(ages, rows, cols)" in str(e)
+
 if __name__ == "__main__":
     test_nearest_neighbour()
     test_exponential()
     # test_fast_exponential()
     test_stratified_topography()
+    test_nearest_neighbour_stencil()
+    test_kronecker()
+    test_kronecker_sparse()
+    test_kronecker_rejects_flat_state()
 
 